@@ -11,6 +11,7 @@ import importlib
 import glob
 import asyncio
 import re
+import threading
 from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, Optional, Union, Dict, Any, List
 from importlib.metadata import version
@@ -46,13 +47,26 @@ logging_levels = {
 # Initialize Flask app
 app = Flask(__name__)
 
+# The local inference client owns model/tokenizer caches and is expensive to
+# construct, so build it once per process instead of per request
+_local_inference_client = None
+_local_inference_client_lock = threading.Lock()
+
+def get_local_inference_client():
+    global _local_inference_client
+    if _local_inference_client is None:
+        with _local_inference_client_lock:
+            if _local_inference_client is None:
+                from optillm.inference import create_inference_client
+                _local_inference_client = create_inference_client()
+    return _local_inference_client
+
 def get_config():
     API_KEY = None
     if os.environ.get("OPTILLM_API_KEY"):
         # Use local inference engine
-        from optillm.inference import create_inference_client
         API_KEY = os.environ.get("OPTILLM_API_KEY")
-        default_client = create_inference_client()
+        default_client = get_local_inference_client()
     # Cerebras, OpenAI, Azure, or LiteLLM API configuration
     elif os.environ.get("CEREBRAS_API_KEY"):
         API_KEY = os.environ.get("CEREBRAS_API_KEY")
@@ -599,7 +599,10 @@ class ModelManager:
                     model_kwargs["attn_implementation"] = "flash_attention_2"
                 except ImportError:
                     has_flash_attn = False
-                    logger.info("Flash Attention 2 is not installed - falling back to default attention")
+                    # Prefer PyTorch's fused SDPA kernels over eager attention
+                    # when flash-attn is not installed
+                    model_kwargs["attn_implementation"] = "sdpa"
+                    logger.info("Flash Attention 2 is not installed - falling back to SDPA attention")
                     
             elif 'mps' in device:
                 # MPS supports FP16
@@ -1470,9 +1473,10 @@ class InferenceClient:
                         else:
                             raise ValueError(f"Unknown specialized decoding approach: {decoding}")
                         
-                        # Calculate prompt tokens for specialized approaches
-                        prompt_text = pipeline.tokenizer.apply_chat_template(messages, tokenize=False)
-                        prompt_tokens = len(pipeline.tokenizer.encode(prompt_text))
+                        # Calculate prompt tokens for specialized approaches.
+                        # Tokenize directly rather than rendering the template to
+                        # a string and re-encoding it - one pass instead of two.
+                        prompt_tokens = len(pipeline.tokenizer.apply_chat_template(messages, tokenize=True))
                         
                     else:
                         # Standard generation
@@ -1,11 +1,72 @@
+import inspect
+import queue
+import threading
+import numpy as np
 import torch
-import random
+from collections import deque
+from concurrent.futures import Future
+from functools import lru_cache
 from transformers import PreTrainedModel, PreTrainedTokenizer, DynamicCache
 from typing import Tuple, Dict, Any, List
 import logging
 
+try:
+    from transformers import StaticCache
+except ImportError:  # older transformers releases
+    StaticCache = None
+
+try:
+    from transformers import SinkCache
+except ImportError:  # older transformers releases
+    SinkCache = None
+
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+
+@lru_cache(maxsize=16)
+def _build_switch_automaton(sequences):
+    """Build an Aho-Corasick automaton over the switch-marker token sequences.
+
+    Returns (goto, fail, accept) where goto is a per-state dict of token id to
+    next state, fail holds the failure links, and accept marks states that
+    complete (or contain, via failure links) a full marker sequence. A new
+    processor is constructed per request while the marker set almost never
+    changes, so builds are memoized on the (hashable) sequence tuple; the
+    returned structure is only ever read, with matcher state kept per
+    processor.
+    """
+    goto = [{}]
+    fail = [0]
+    accept = [False]
+    for seq in sequences:
+        state = 0
+        for token in seq:
+            if token not in goto[state]:
+                goto.append({})
+                fail.append(0)
+                accept.append(False)
+                goto[state][token] = len(goto) - 1
+            state = goto[state][token]
+        accept[state] = True
+    # Breadth-first fill of failure links, propagating accept states
+    pending = deque(goto[0].values())
+    while pending:
+        state = pending.popleft()
+        for token, nxt in goto[state].items():
+            pending.append(nxt)
+            f = fail[state]
+            while f and token not in goto[f]:
+                f = fail[f]
+            fail[nxt] = goto[f].get(token, 0) if goto[f].get(token, 0) != nxt else 0
+            accept[nxt] = accept[nxt] or accept[fail[nxt]]
+    return goto, fail, accept
+
+# Extra KV-cache capacity reserved beyond max_thinking_tokens for injected
+# thought transitions and the conclusion generated after the think block.
+STATIC_CACHE_HEADROOM = 2048
+
+# Attention-sink tokens kept at the start of a windowed KV cache; without them
+# sliding-window eviction destabilizes generation (StreamingLLM).
+NUM_SINK_TOKENS = 4
 
 DEFAULT_CONFIG = {
     "min_thinking_tokens": 1024,
@@ -18,6 +79,9 @@ DEFAULT_CONFIG = {
         "Wait,",
         "Alternatively,",
     ],
+    "top_k": 50,
+    "temperature": 1.0,
+    "kv_window": None,
 }
 
 class ThinkDeeperProcessor:
@@ -38,35 +102,202 @@ class ThinkDeeperProcessor:
             # Encode without adding special tokens to get exact sequence
             token_ids = self.tokenizer.encode(phrase, add_special_tokens=False)
             self.thought_switch_sequences.append(token_ids)
-            logger.debug(f"Encoded '{phrase}' to token sequence: {token_ids}")
-            logger.debug(f"Decoded back: {self.tokenizer.decode(token_ids)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Encoded '{phrase}' to token sequence: {token_ids}")
+                logger.debug(f"Decoded back: {self.tokenizer.decode(token_ids)}")
         
-        # Track thought switches
+        # Sampling controls: restrict sampling to the top_k logits (0 disables
+        # the restriction) and scale by temperature before drawing
+        self._top_k = int(self.config["top_k"] or 0)
+        self._temperature = float(self.config["temperature"])
+
+        # Track thought switches. Matching runs a token-level Aho-Corasick
+        # automaton: each generated token advances the matcher by one
+        # transition instead of re-scanning a window of recent tokens against
+        # every marker sequence.
         self.thought_count = 0
-        self.current_sequence = []  # Track recent tokens for sequence matching
-        self.max_sequence_length = max(len(seq) for seq in self.thought_switch_sequences)
+        self._switch_automaton = _build_switch_automaton(
+            tuple(tuple(seq) for seq in self.thought_switch_sequences)
+        )
+        self._switch_state = 0
+
+        # Keep the sampled token on-device between steps so the next forward can
+        # launch without a blocking CPU round trip. The Python-side control flow
+        # still needs the token id, so read it back through a pinned staging
+        # buffer with a non-blocking copy instead of a full-stream .item() sync.
+        self._on_cuda = self.model.device.type == "cuda"
+
+        # Only the last position's logits are ever read, so ask the model to
+        # run the lm_head on just that row when its forward supports it -
+        # otherwise prefill materializes a full [1, prompt_len, vocab] logits
+        # tensor to read one row out of it. The kwarg was renamed from
+        # num_logits_to_keep to logits_to_keep across transformers releases.
+        forward_params = inspect.signature(self.model.forward).parameters
+        if "logits_to_keep" in forward_params:
+            self._logits_kwargs = {"logits_to_keep": 1}
+        elif "num_logits_to_keep" in forward_params:
+            self._logits_kwargs = {"num_logits_to_keep": 1}
+        else:
+            self._logits_kwargs = {}
+
+        # Compile the single-token decode step so its hundreds of kernel
+        # launches can be captured as a CUDA graph and replayed with one
+        # launch per token. Only usable with StaticCache (fixed shapes and a
+        # stable cache address); compilation happens lazily on first call and
+        # the first failure drops back to eager for the rest of the run.
+        self._compiled_decode_step = None
+        if self._on_cuda and StaticCache is not None and hasattr(torch, "compile"):
+            self._compiled_decode_step = torch.compile(
+                self._decode_step, mode="reduce-overhead", fullgraph=True, dynamic=False
+            )
+        if self._on_cuda:
+            self._token_readback = torch.empty(1, dtype=torch.long, pin_memory=True)
+            self._token_readback_event = torch.cuda.Event()
 
-        for phrase, sequence in zip(self.config["thought_switch_tokens"], self.thought_switch_sequences):
-            logger.debug(f"Thought switch marker '{phrase}' encoded as: {sequence}")
-            logger.debug(f"Decoded back as: {self.tokenizer.decode(sequence)}")
+        # Precompute the end-of-generation token set once. eos_token_id can be
+        # a single id or a list depending on the model config, and chasing the
+        # config attribute plus normalizing it on every loop iteration is
+        # avoidable work on the per-token path.
+        eos = self.model.config.eos_token_id
+        self._eos_token_ids = frozenset(eos if isinstance(eos, (list, tuple)) else [eos])
+
+        # Tokenize the fixed thought-transition phrases once; encoding them (and
+        # moving them to the device) inside the loop was pure repeated work.
+        self._replacement_token_ids = [
+            self.tokenizer.encode(phrase, add_special_tokens=False)
+            for phrase in self.config["thought_switch_tokens"]
+        ]
+        self._replacement_tensors = []
+        for ids in self._replacement_token_ids:
+            staged = torch.tensor([ids], dtype=torch.long)
+            if self._on_cuda:
+                # Stage through pinned memory so the copy is a true async DMA
+                staged = staged.pin_memory()
+            self._replacement_tensors.append(staged.to(self.model.device, non_blocking=True))
+
+        if logger.isEnabledFor(logging.DEBUG):
+            for phrase, sequence in zip(self.config["thought_switch_tokens"], self.thought_switch_sequences):
+                logger.debug(f"Thought switch marker '{phrase}' encoded as: {sequence}")
+                logger.debug(f"Decoded back as: {self.tokenizer.decode(sequence)}")
 
     def is_thought_switch(self, token: int) -> bool:
-        """Check if adding this token creates a thought switch sequence."""
-        # Add new token to current sequence
-        self.current_sequence.append(token)
-        
-        # Keep only the most recent tokens that could match our sequences
-        if len(self.current_sequence) > self.max_sequence_length:
-            self.current_sequence = self.current_sequence[-self.max_sequence_length:]
-        
-        # Check if current sequence ends with any thought switch sequence
-        for sequence in self.thought_switch_sequences:
-            if len(sequence) <= len(self.current_sequence) and \
-               self.current_sequence[-len(sequence):] == sequence:
-                return True
-        
-        return False
-        
+        """Check if adding this token completes a thought switch sequence."""
+        goto, fail, accept = self._switch_automaton
+        state = self._switch_state
+        while state and token not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(token, 0)
+        self._switch_state = state
+        return accept[state]
+
+    def _decode_step(self, input_ids, cache_position, past_key_values):
+        """One fixed-shape decode forward; the unit torch.compile captures."""
+        return self.model(
+            input_ids=input_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            cache_position=cache_position,
+            **self._logits_kwargs,
+        )
+
+    def _read_token(self, token_t: torch.Tensor) -> int:
+        """Bring a sampled 1-element token tensor back to the CPU.
+
+        On CUDA this copies into a pinned buffer and waits only on that copy
+        (via a CUDA event) rather than synchronizing the whole stream.
+        """
+        if self._on_cuda:
+            self._token_readback.copy_(token_t.view(1), non_blocking=True)
+            self._token_readback_event.record()
+            self._token_readback_event.synchronize()
+            return int(self._token_readback[0])
+        return int(token_t.item())
+
+    def _sample_next_token(self, logits: torch.Tensor) -> torch.Tensor:
+        """Sample one token from the logits via the Gumbel-max trick.
+
+        Equivalent in distribution to softmax + multinomial but never
+        materializes the normalized probabilities: one elementwise perturbation
+        and an argmax, with no validation kernels or internal syncs. With
+        top_k set, sampling happens over the k largest logits so the
+        perturbation and reduction touch k entries instead of the full vocab.
+        """
+        if self._top_k:
+            top_logits, top_indices = torch.topk(logits, min(self._top_k, logits.shape[-1]))
+            if self._temperature != 1.0:
+                top_logits = top_logits / self._temperature
+            gumbel = -torch.empty_like(top_logits).exponential_().log_()
+            idx = (top_logits + gumbel).argmax(dim=-1, keepdim=True)
+            return top_indices.gather(-1, idx)
+        if self._temperature != 1.0:
+            logits = logits / self._temperature
+        gumbel = -torch.empty_like(logits).exponential_().log_()
+        return (logits + gumbel).argmax(dim=-1, keepdim=True)
+
+    def _init_cache(self, prompt_len: int):
+        """Build the KV cache for one generation.
+
+        With kv_window set, a SinkCache caps the cache (and every attention
+        read) at the window plus a few attention-sink tokens instead of
+        growing with the full thinking trace. Otherwise, on CUDA a
+        preallocated StaticCache keeps every decode step at a fixed shape (a
+        prerequisite for CUDA-graph capture) and avoids the per-step
+        reallocation DynamicCache does as it grows. Falls back to DynamicCache
+        when neither applies or allocation fails.
+        """
+        kv_window = self.config["kv_window"]
+        if kv_window:
+            if SinkCache is not None:
+                return SinkCache(window_length=kv_window, num_sink_tokens=NUM_SINK_TOKENS), None
+            logger.warning("kv_window is set but SinkCache is unavailable in this transformers version - using DynamicCache")
+            return DynamicCache(), None
+        if self._on_cuda and StaticCache is not None:
+            max_cache_len = prompt_len + self.config["max_thinking_tokens"] + STATIC_CACHE_HEADROOM
+            try:
+                kv = StaticCache(
+                    config=self.model.config,
+                    max_batch_size=1,
+                    max_cache_len=max_cache_len,
+                    device=self.model.device,
+                    dtype=self.model.dtype,
+                )
+                return kv, max_cache_len
+            except Exception as e:
+                logger.warning(f"Could not allocate StaticCache, falling back to DynamicCache: {e}")
+        return DynamicCache(), None
+
+    def _generate_conclusion(self, prompt_tokens, generated_ids, kv, max_new_tokens):
+        """Finish the post-think answer with the model's generate() path.
+
+        Once the think block is closed there is no per-token bookkeeping left
+        (no switch matching, no replacement injection), so the remainder of the
+        answer can run on HF's optimized generation loop, reusing the KV cache
+        built up by the manual loop. Returns the newly generated token ids.
+        """
+        input_ids = torch.cat(
+            [prompt_tokens,
+             torch.tensor([generated_ids], dtype=torch.long, device=self.model.device)],
+            dim=1,
+        )
+        cache_len = kv.get_seq_length()
+        if input_ids.shape[1] > cache_len + 1:
+            # A windowed cache has evicted old tokens; feed only the tail the
+            # cache can account for so generate processes just the uncached
+            # trigger token instead of re-running evicted history
+            input_ids = input_ids[:, -(cache_len + 1):]
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = next(iter(self._eos_token_ids))
+        out = self.model.generate(
+            input_ids=input_ids,
+            past_key_values=kv,
+            do_sample=True,
+            max_new_tokens=max_new_tokens,
+            use_cache=True,
+            pad_token_id=pad_token_id,
+        )
+        return out[0, input_ids.shape[1]:].tolist()
+
     @torch.inference_mode()
     def reasoning_effort(self, messages) -> str:
         """Generate response with ThinkDeeper's controlled thinking process"""
@@ -79,14 +310,51 @@ class ThinkDeeperProcessor:
             return_tensors="pt"
         )
         tokens = tokens.to(self.model.device)
+        prompt_tokens = tokens
+
+        kv, max_cache_len = self._init_cache(tokens.shape[1])
+        use_static_cache = max_cache_len is not None
+        pos = 0
+
+        # Thought transitions are bounded by max_thoughts, so draw every
+        # replacement pick up front in one vectorized call instead of hitting
+        # Python's RNG from inside the loop.
+        replacement_draws = np.random.randint(
+            0, len(self._replacement_tensors) or 1, size=self.config["max_thoughts"] + 1
+        )
+        draws_used = 0
 
-        kv = DynamicCache()
         n_thinking_tokens = 0
         seen_end_think = False
-        response_chunks = []
+        # Accumulate token ids and detokenize once at the end instead of paying
+        # a decode call per token; replacement strings are recorded as literal
+        # segments so they splice in at the right position.
+        response_segments = []  # literal strings and lists of token ids, in order
+        response_ids = []
+        # Every id fed to the model after the prompt, used to hand the
+        # conclusion off to generate() with the full input sequence
+        generated_ids = []
         
         while True:
-            out = self.model(input_ids=tokens, past_key_values=kv, use_cache=True)
+            if use_static_cache:
+                if pos + tokens.shape[1] > max_cache_len:
+                    logger.warning("KV cache capacity reached - stopping generation early")
+                    break
+                # StaticCache needs explicit write positions for each new token
+                cache_position = torch.arange(pos, pos + tokens.shape[1], device=self.model.device)
+                if self._compiled_decode_step is not None and tokens.shape[1] == 1:
+                    try:
+                        out = self._compiled_decode_step(tokens, cache_position, kv)
+                    except Exception as e:
+                        logger.warning(f"Compiled decode step failed, falling back to eager: {e}")
+                        self._compiled_decode_step = None
+                        out = self._decode_step(tokens, cache_position, kv)
+                else:
+                    out = self._decode_step(tokens, cache_position, kv)
+            else:
+                out = self.model(input_ids=tokens, past_key_values=kv, use_cache=True,
+                                 **self._logits_kwargs)
+            pos += tokens.shape[1]
             logits = out.logits[0, -1, :]
             
             # Check if we need to force end thinking
@@ -94,27 +362,27 @@ class ThinkDeeperProcessor:
                         self.thought_count >= self.config["max_thoughts"])
             
             if force_end and not seen_end_think:
-                logger.debug(f"Forcing end think token. Tokens: {n_thinking_tokens}, Thoughts: {self.thought_count}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Forcing end think token. Tokens: {n_thinking_tokens}, Thoughts: {self.thought_count}")
                 next_token = self.end_think_token
-                response_chunks.append(self.tokenizer.decode([next_token]))
+                response_ids.append(next_token)
+                generated_ids.append(next_token)
                 seen_end_think = True
-                # Don't break - continue generating but with end_think token forced
-                tokens = torch.tensor([[next_token]]).to(tokens.device)
-                continue
+                # Thinking is over - hand the conclusion to generate()
+                break
             else:
-                next_token = torch.multinomial(
-                    torch.softmax(logits, dim=-1), 1
-                ).item()
-            
+                next_token_t = self._sample_next_token(logits)
+                next_token = self._read_token(next_token_t)
+
             kv = out.past_key_values
-            next_str = self.tokenizer.decode([next_token])
-            
+
             # Check if this is a thought-switching token (only if not in conclusion phase)
             if not seen_end_think and self.is_thought_switch(next_token):
                 self.thought_count += 1
-                logger.debug(f"Detected thought switch marker. Total thoughts: {self.thought_count}")
-                # Clear the sequence after detecting a switch
-                self.current_sequence = []
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Detected thought switch marker. Total thoughts: {self.thought_count}")
+                # Reset the matcher after detecting a switch
+                self._switch_state = 0
 
             # Handle natural end think token
             if next_token == self.end_think_token:
@@ -123,54 +391,123 @@ class ThinkDeeperProcessor:
                 
                 # If we haven't reached minimum tokens, continue with thought transition
                 if n_thinking_tokens < self.config["min_thinking_tokens"]:
-                    replacement = random.choice(self.config["thought_switch_tokens"])
-                    logger.debug(f"Inserting thought transition: '{replacement}' (tokens: {n_thinking_tokens})")
-                    response_chunks.append(replacement)
-                    replacement_tokens = self.tokenizer.encode(replacement)
-                    n_thinking_tokens += len(replacement_tokens)
-                    tokens = torch.tensor([replacement_tokens]).to(tokens.device)
+                    idx = int(replacement_draws[draws_used % replacement_draws.size])
+                    draws_used += 1
+                    replacement = self.config["thought_switch_tokens"][idx]
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Inserting thought transition: '{replacement}' (tokens: {n_thinking_tokens})")
+                    if response_ids:
+                        response_segments.append(response_ids)
+                        response_ids = []
+                    response_segments.append(replacement)
+                    n_thinking_tokens += len(self._replacement_token_ids[idx])
+                    generated_ids.extend(self._replacement_token_ids[idx])
+                    tokens = self._replacement_tensors[idx]
                     self.thought_count += 1
                     seen_end_think = False
                     continue
 
             # Handle EOS token
-            if next_token == self.model.config.eos_token_id:
+            if next_token in self._eos_token_ids:
                 logger.debug("Found eos token")
-                if seen_end_think:
-                    logger.debug("Reached EOS after end think token - stopping generation")
-                    response_chunks.append(next_str)
-                    break
-                elif n_thinking_tokens < self.config["min_thinking_tokens"]:
+                if n_thinking_tokens < self.config["min_thinking_tokens"]:
                     # Continue with thought transition if under minimum tokens
-                    replacement = random.choice(self.config["thought_switch_tokens"])
-                    logger.debug(f"Inserting thought transition: '{replacement}' (tokens: {n_thinking_tokens})")
-                    response_chunks.append(replacement)
-                    replacement_tokens = self.tokenizer.encode(replacement)
-                    n_thinking_tokens += len(replacement_tokens)
-                    tokens = torch.tensor([replacement_tokens]).to(tokens.device)
+                    idx = int(replacement_draws[draws_used % replacement_draws.size])
+                    draws_used += 1
+                    replacement = self.config["thought_switch_tokens"][idx]
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Inserting thought transition: '{replacement}' (tokens: {n_thinking_tokens})")
+                    if response_ids:
+                        response_segments.append(response_ids)
+                        response_ids = []
+                    response_segments.append(replacement)
+                    n_thinking_tokens += len(self._replacement_token_ids[idx])
+                    generated_ids.extend(self._replacement_token_ids[idx])
+                    tokens = self._replacement_tensors[idx]
                     self.thought_count += 1
                     continue
                 else:
-                    # Force end think token and continue generating for natural conclusion
+                    # Force end think token and finish the conclusion on the fast path
                     logger.debug("Reached EOS without end think token - adding end token and continuing generation")
-                    response_chunks.append(self.tokenizer.decode([self.end_think_token]))
-                    tokens = torch.tensor([[self.end_think_token]]).to(tokens.device)
+                    response_ids.append(self.end_think_token)
+                    generated_ids.append(self.end_think_token)
                     seen_end_think = True
-                    continue
+                    break
             
             # Normal token processing
-            response_chunks.append(next_str)
+            response_ids.append(next_token)
+            generated_ids.append(next_token)
             if not seen_end_think:
                 n_thinking_tokens += 1
-            tokens = torch.tensor([[next_token]]).to(tokens.device)
+            # Feed the device-resident sample straight into the next forward
+            tokens = next_token_t.view(1, 1)
+            if seen_end_think:
+                # The think block just closed naturally - hand the rest of the
+                # answer to generate() instead of stepping a token at a time
+                break
 
-        # Join all chunks and add framing tokens
-        response = "".join(response_chunks)
-        full_response = f"{self.config['start_think_token']}\n{self.config['prefill']}{response}"
+        if seen_end_think:
+            if use_static_cache:
+                budget = max_cache_len - prompt_tokens.shape[1] - len(generated_ids)
+            else:
+                budget = STATIC_CACHE_HEADROOM
+            if budget > 0:
+                response_ids.extend(
+                    self._generate_conclusion(prompt_tokens, generated_ids, kv, budget)
+                )
+
+        # Detokenize each run of ids in one call and assemble the final string
+        # with a single join, framing tokens included, instead of building the
+        # full-length response twice (join + f-string concatenation).
+        if response_ids:
+            response_segments.append(response_ids)
+        parts = [self.config['start_think_token'], "\n", self.config['prefill']]
+        parts.extend(
+            segment if isinstance(segment, str) else self.tokenizer.decode(segment)
+            for segment in response_segments
+        )
+        full_response = "".join(parts)
         
         logger.debug(f"Final response length: {len(full_response)} chars, Total thoughts: {self.thought_count}")
         return full_response
 
+# A single engine thread owns all thinkdeeper generation. Concurrent server
+# threads would otherwise interleave their decode loops on the one shared
+# model - thrashing the KV caches and serializing anyway on the GPU with extra
+# contention - so requests are funneled through a queue and handled by one
+# consumer. The queue is also the natural seam for batching compatible
+# requests later; true microbatched decode does not fit this loop today
+# because replacement injection advances rows by different token counts.
+_request_queue: queue.Queue = queue.Queue()
+_engine_thread = None
+_engine_lock = threading.Lock()
+
+
+def _engine_loop():
+    while True:
+        config, tokenizer, model, messages, future = _request_queue.get()
+        if not future.set_running_or_notify_cancel():
+            _request_queue.task_done()
+            continue
+        try:
+            processor = ThinkDeeperProcessor(config, tokenizer, model)
+            future.set_result(processor.reasoning_effort(messages))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            _request_queue.task_done()
+
+
+def _ensure_engine_thread():
+    global _engine_thread
+    if _engine_thread is None:
+        with _engine_lock:
+            if _engine_thread is None:
+                thread = threading.Thread(target=_engine_loop, name="thinkdeeper-engine", daemon=True)
+                thread.start()
+                _engine_thread = thread
+
+
 def thinkdeeper_decode(
     model: PreTrainedModel, 
     tokenizer: PreTrainedTokenizer, 
@@ -191,9 +528,10 @@ def thinkdeeper_decode(
     logger.info(f"Using config: {config}")
     
     try:
-        processor = ThinkDeeperProcessor(config, tokenizer, model)
-        response = processor.reasoning_effort(messages)
-        return response
+        _ensure_engine_thread()
+        future = Future()
+        _request_queue.put((config, tokenizer, model, messages, future))
+        return future.result()
         
     except Exception as e:
         logger.error(f"Error in ThinkDeeper processing: {str(e)}")